@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+    from json import loads as json_loads
+
+    def json_dumps(value: Any) -> bytes:
+        return json.dumps(value).encode()
+
+log = logging.getLogger("reviewer.cache")
+
+CACHE_DIR = Path.home() / ".cache" / "gemini_reviewer"
+# Cached reviews older than this are treated as missing and deleted
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Per-process memo of entries already read or written, so repeated lookups
+# of the same key skip the filesystem
+_memory: Dict[str, Any] = {}
+
+
+def is_enabled() -> bool:
+    """Returns False when the cache is bypassed with REVIEWER_NO_CACHE=1."""
+    return os.environ.get("REVIEWER_NO_CACHE") != "1"
+
+
+def make_key(*parts: Any) -> str:
+    """Builds a SHA-256 cache key from the model settings and prompt."""
+    # Separate the parts so e.g. temperature/token pairs can't run together and collide
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def sweep() -> None:
+    """Deletes expired entries and leftover temp files from the cache directory.
+
+    The directory is carried between workflow runs, so without this it would
+    grow with every run.
+    """
+    if not is_enabled() or not CACHE_DIR.is_dir():
+        return
+    now = time.time()
+    removed = 0
+    for path in [*CACHE_DIR.glob("*.json"), *CACHE_DIR.glob("*.tmp")]:
+        try:
+            if now - path.stat().st_mtime > CACHE_TTL_SECONDS or path.suffix == ".tmp":
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        log.info("Removed %d stale cache files", removed)
+
+
+def get(key: str) -> Optional[Any]:
+    """Returns the cached value for key, or None on a miss or expired entry."""
+    if not is_enabled():
+        return None
+    if key in _memory:
+        return _memory[key]
+
+    path = CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - path.stat().st_mtime > CACHE_TTL_SECONDS:
+            path.unlink()
+            return None
+        value = json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+    _memory[key] = value
+    return value
+
+
+def put(key: str, value: Any) -> None:
+    """Stores value under key in memory and on disk."""
+    if not is_enabled():
+        return
+    _memory[key] = value
+
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file first so concurrent readers never see a partial entry
+        tmp_path = CACHE_DIR / f"{key}.{os.getpid()}.tmp"
+        tmp_path.write_bytes(json_dumps(value))
+        os.replace(tmp_path, CACHE_DIR / f"{key}.json")
+    except OSError as e:
+        log.warning("Failed to write cache entry %s: %s", key, e)
@@ -1,19 +1,114 @@
-import json
+import asyncio
+import functools
+import hashlib
+import logging
 import os
-from typing import List, Dict, Any
+import re
+from collections import namedtuple
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Pattern, Tuple
 import google.generativeai as Client
 from github import Github
 import difflib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import fnmatch
-from unidiff import Hunk, PatchedFile, PatchSet
+import cache
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+log = logging.getLogger("reviewer")
 
 GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
+GITHUB_POOL_SIZE = 16
+# Read size for streaming the diff; large diffs are the case streaming is for
+DIFF_CHUNK_SIZE = 64 * 1024
+
+
+def github_retry() -> Retry:
+    """Retry policy for transient GitHub API failures."""
+    return Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+
+
+# Shared keep-alive session for raw GitHub REST calls, so every request after
+# the first reuses the same TLS connection
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=GITHUB_POOL_SIZE, max_retries=github_retry()))
+SESSION.headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
 
 # Initialize GitHub and Gemini clients
-gh = Github(GITHUB_TOKEN)
+gh = Github(GITHUB_TOKEN, retry=github_retry(), pool_size=GITHUB_POOL_SIZE)
 gemini_client = Client.configure(api_key=os.environ.get('GEMINI_API_KEY'))
 
+# Use 'gemini-1.5-flash-002' as a fallback default value if the environment variable isn't set
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash-002')
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    # Structured output: Gemini returns bare JSON matching response_schema
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "reviews": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "lineNumber": {"type": "integer"},
+                        "reviewComment": {"type": "string"},
+                    },
+                    "required": ["lineNumber", "reviewComment"],
+                },
+            },
+        },
+        "required": ["reviews"],
+    },
+}
+
+# Output token budget per hunk scales with the number of changed lines
+MAX_OUTPUT_TOKENS = 700
+MIN_OUTPUT_TOKENS = 200
+OUTPUT_TOKENS_PER_CHANGED_LINE = 40
+
+# Unchanged lines kept on each side of a change when building the prompt
+PROMPT_CONTEXT_LINES = 3
+# Hard cap on the diff text sent per hunk
+MAX_PROMPT_DIFF_CHARS = 8000
+PROMPT_TRUNCATION_MARKER = "... (diff truncated, remaining lines not shown)"
+
+# Upper bound on in-flight Gemini requests, to stay within the API quota
+GEMINI_CONCURRENCY = max(1, int(os.environ.get('GEMINI_CONCURRENCY', '8')))
+
+# Per-PR review limits; past these, only the hunks with the densest changes are reviewed
+REVIEWER_MAX_HUNKS = int(os.environ.get('REVIEWER_MAX_HUNKS', '40'))
+REVIEWER_MAX_BYTES = int(os.environ.get('REVIEWER_MAX_BYTES', '400000'))
+
+REVIEW_BODY = "Gemini AI Code Reviewer Comments"
+
+# Gemini rejects context caches smaller than this many tokens
+MIN_CACHED_CONTENT_TOKENS = 32768
+PROMPT_CACHE_TTL_SECONDS = 300
+
+
+@functools.lru_cache(maxsize=None)
+def get_repo(full_name: str):
+    """Returns the GitHub repository, fetched at most once per run."""
+    return gh.get_repo(full_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_pull(full_name: str, pull_number: int):
+    """Returns the pull request, fetched at most once per run."""
+    return get_repo(full_name).get_pull(pull_number)
+
+
+# Lightweight holders for the parts of a diff file/hunk the reviewer uses
+FileInfo = namedtuple("FileInfo", "path")
+HunkInfo = namedtuple("HunkInfo", "content source_start source_length")
+
 
 class PRDetails:
     def __init__(self, owner: str, repo: str, pull_number: int, title: str, description: str):
@@ -24,10 +119,14 @@ class PRDetails:
         self.description = description
 
 
-def get_pr_details() -> PRDetails:
-    """Retrieves details of the pull request from GitHub Actions event payload."""
-    with open(os.environ["GITHUB_EVENT_PATH"], "r") as f:
-        event_data = json.load(f)
+def load_event() -> Tuple[PRDetails, Dict[str, Any]]:
+    """Reads the GitHub Actions event payload and retrieves the pull request details.
+
+    Returns the raw event data alongside the details so callers don't need to
+    read the payload again.
+    """
+    with open(os.environ["GITHUB_EVENT_PATH"], "rb") as f:
+        event_data = json_loads(f.read())
 
     # Handle comment trigger differently from direct PR events
     if "issue" in event_data and "pull_request" in event_data["issue"]:
@@ -41,98 +140,260 @@ def get_pr_details() -> PRDetails:
 
     owner, repo = repo_full_name.split("/")
 
-    repo = gh.get_repo(repo_full_name)
-    pr = repo.get_pull(pull_number)
+    pr = get_pull(repo_full_name, pull_number)
 
-    return PRDetails(owner, repo.name, pull_number, pr.title, pr.body)
+    return PRDetails(owner, repo, pull_number, pr.title, pr.body), event_data
 
 
-def get_diff(owner: str, repo: str, pull_number: int) -> str:
-    """Fetches the diff of the pull request from GitHub API."""
+def get_diff(owner: str, repo: str, pull_number: int) -> Iterator[str]:
+    """Streams the diff of the pull request from GitHub API line by line.
+
+    Lines are yielded while the response is still downloading, so parsing
+    overlaps the network transfer and the full diff is never held as one string.
+    """
     # Use the correct repository name format
     repo_name = f"{owner}/{repo}"
-    print(f"Attempting to get diff for: {repo_name} PR#{pull_number}")
+    log.info("Attempting to get diff for: %s PR#%s", repo_name, pull_number)
 
-    repo = gh.get_repo(repo_name)
-    pr = repo.get_pull(pull_number)
-    
-    # Use the GitHub API URL directly
+    # Ask the pulls endpoint for the diff media type directly; this avoids the
+    # redirect behind the browser-facing diff URL and lets GitHub gzip the body
     api_url = f"https://api.github.com/repos/{repo_name}/pulls/{pull_number}"
 
     headers = {
-        'Authorization': f'Bearer {GITHUB_TOKEN}',  # Changed to Bearer format
-        'Accept': 'application/vnd.github.v3.diff'
+        'Accept': 'application/vnd.github.v3.diff',
+        'Accept-Encoding': 'gzip',
     }
 
-    response = requests.get(f"{api_url}.diff", headers=headers)
-    
-    if response.status_code == 200:
-        diff = response.text
-        print(f"Retrieved diff length: {len(diff) if diff else 0}")
-        return diff
-    else:
-        print(f"Failed to get diff. Status code: {response.status_code}")
-        print(f"Response content: {response.text}")
-        print(f"URL attempted: {api_url}.diff")
-        return ""
+    with SESSION.get(api_url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code != 200:
+            log.error("Failed to get diff. Status code: %s", response.status_code)
+            log.error("Response content: %s", response.text)
+            log.error("URL attempted: %s", api_url)
+            return
 
+        response.encoding = response.encoding or 'utf-8'
+        line_count = 0
+        # Split on '\n' ourselves and carry the partial last line into the next
+        # chunk; iter_lines() emits a spurious empty line when a CRLF pair
+        # straddles a chunk boundary
+        pending = ""
+        for chunk in response.iter_content(chunk_size=DIFF_CHUNK_SIZE, decode_unicode=True):
+            lines = (pending + chunk).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                line_count += 1
+                yield line[:-1] if line.endswith("\r") else line
+        if pending:
+            line_count += 1
+            yield pending[:-1] if pending.endswith("\r") else pending
+        log.info("Retrieved diff lines: %d", line_count)
+
+
+def is_changed_line(line: str) -> bool:
+    """Returns True for added or removed diff lines.
+
+    parse_diff keeps file headers out of hunk lines, so '+++'/'---' here are
+    real changes (e.g. '++count;' or a removed '-- comment').
+    """
+    return line[:1] in ('+', '-')
+
+
+def hunk_has_changes(hunk_lines: List[str]) -> bool:
+    """Returns True if the hunk adds or removes at least one line."""
+    return any(is_changed_line(line) for line in hunk_lines)
+
+
+def output_token_budget(hunk_lines: List[str]) -> int:
+    """Returns the max_output_tokens for a hunk, proportional to its changed lines.
+
+    The floor keeps a single review comment from being cut off mid-JSON.
+    """
+    changed_lines = sum(1 for line in hunk_lines if is_changed_line(line))
+    return max(MIN_OUTPUT_TOKENS, min(MAX_OUTPUT_TOKENS, OUTPUT_TOKENS_PER_CHANGED_LINE * changed_lines))
+
+
+def change_density(hunk_lines: List[str]) -> float:
+    """Returns the fraction of hunk lines that are added or removed."""
+    return sum(1 for line in hunk_lines if is_changed_line(line)) / max(1, len(hunk_lines))
+
+
+def limit_hunks(parsed_diff: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Caps the diff at REVIEWER_MAX_HUNKS hunks and REVIEWER_MAX_BYTES of hunk text.
+
+    When the diff is over either limit, hunks are ranked by change density and
+    the densest ones that fit are kept. Returns the limited diff together with
+    the sorted paths of files that had hunks dropped.
+    """
+    candidates = [
+        hunk_data
+        for file_data in parsed_diff
+        if file_data.get('path', '') not in ('', '/dev/null')
+        for hunk_data in file_data.get('hunks', [])
+        if hunk_has_changes(hunk_data.get('lines', []))
+    ]
+    # Character count of the hunk text, a close enough stand-in for its byte size
+    sizes = {id(hunk_data): sum(len(line) + 1 for line in hunk_data['lines']) for hunk_data in candidates}
+    if len(candidates) <= REVIEWER_MAX_HUNKS and sum(sizes.values()) <= REVIEWER_MAX_BYTES:
+        return parsed_diff, []
+
+    kept = set()
+    kept_bytes = 0
+    for hunk_data in sorted(candidates, key=lambda h: change_density(h['lines']), reverse=True):
+        if len(kept) >= REVIEWER_MAX_HUNKS:
+            break
+        if kept_bytes + sizes[id(hunk_data)] > REVIEWER_MAX_BYTES:
+            continue
+        kept.add(id(hunk_data))
+        kept_bytes += sizes[id(hunk_data)]
+
+    log.warning(
+        "Diff exceeds review limits (%d hunks, %d bytes); reviewing %d hunks",
+        len(candidates), sum(sizes.values()), len(kept),
+    )
+    skipped_files = sorted({
+        file_data['path']
+        for file_data in parsed_diff
+        for hunk_data in file_data.get('hunks', [])
+        if id(hunk_data) in sizes and id(hunk_data) not in kept
+    })
+    limited_diff = [
+        {**file_data, 'hunks': [h for h in file_data.get('hunks', []) if id(h) in kept]}
+        for file_data in parsed_diff
+    ]
+    return limited_diff, skipped_files
+
+
+def build_review_jobs(parsed_diff: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Builds one Gemini request per hunk, keyed by (file_path, hunk_index)."""
+    jobs = []
 
-def analyze_code(parsed_diff: List[Dict[str, Any]], pr_details: PRDetails) -> List[Dict[str, Any]]:
-    """Analyzes the code changes using Gemini and generates review comments."""
-    print("Starting analyze_code...")
-    print(f"Number of files to analyze: {len(parsed_diff)}")
-    comments = []
-    #print(f"Initial comments list: {comments}")
-    
     for file_data in parsed_diff:
         file_path = file_data.get('path', '')
-        print(f"\nProcessing file: {file_path}")
+        log.debug("Processing file: %s", file_path)
 
         if not file_path or file_path == "/dev/null":
             continue
 
-        class FileInfo:
-            def __init__(self, path):
-                self.path = path
-
         file_info = FileInfo(file_path)
 
         hunks = file_data.get('hunks', [])
-        print(f"Hunks in file: {len(hunks)}")
+        log.debug("Hunks in file: %d", len(hunks))
         
-        for hunk_data in hunks:
-            print(f"\nHunk content: {json.dumps(hunk_data, indent=2)}")
+        for hunk_index, hunk_data in enumerate(hunks):
+            log.debug("Hunk content: %s", hunk_data)
             hunk_lines = hunk_data.get('lines', [])
-            print(f"Number of lines in hunk: {len(hunk_lines)}")
+            log.debug("Number of lines in hunk: %d", len(hunk_lines))
 
             if not hunk_lines:
                 continue
+
+            if not hunk_has_changes(hunk_lines):
+                log.debug("Skipping hunk without added or removed lines in %s", file_path)
+                continue
                 
-            hunk = Hunk()
-            hunk.source_start = 1
-            hunk.source_length = len(hunk_lines)
-            hunk.target_start = 1
-            hunk.target_length = len(hunk_lines)
-            hunk.content = '\n'.join(hunk_lines)
+            hunk = HunkInfo(
+                content='\n'.join(hunk_lines),
+                source_start=1,
+                source_length=len(hunk_lines),
+            )
             
-            prompt = create_prompt(file_info, hunk, pr_details)
-            print("Sending prompt to Gemini...")
-            ai_response = get_ai_response(prompt)
-            print(f"AI response received: {ai_response}")
+            jobs.append({
+                "key": (file_path, hunk_index),
+                "file": file_info,
+                "hunk": hunk,
+                "prompt": create_prompt(file_info, hunk),
+                "max_output_tokens": output_token_budget(hunk_lines),
+                # Identical hunk bodies (e.g. the same import block in several
+                # files) share a single Gemini request
+                "digest": hashlib.blake2b(hunk.content.encode(), digest_size=16).digest(),
+            })
+
+    return jobs
+
+
+def create_review_model(system_prompt: str):
+    """Creates the Gemini model shared by every hunk of the pull request.
+
+    The system prompt is identical for all hunks, so it is stored once as
+    Gemini cached content when it is large enough to be cached. Otherwise it
+    is passed as a plain system instruction. Returns the model together with
+    the cached content (or None) so the caller can release it.
+    """
+    # Rough estimate of ~4 characters per token, to avoid a count_tokens round trip
+    if len(system_prompt) // 4 >= MIN_CACHED_CONTENT_TOKENS:
+        try:
+            cached_content = Client.caching.CachedContent.create(
+                model=GEMINI_MODEL,
+                system_instruction=system_prompt,
+                ttl=PROMPT_CACHE_TTL_SECONDS,
+            )
+            log.info("Created Gemini cached content: %s", cached_content.name)
+            return Client.GenerativeModel.from_cached_content(cached_content), cached_content
+        except Exception as e:
+            log.warning("Gemini context caching unavailable, falling back: %s", e)
+
+    return Client.GenerativeModel(GEMINI_MODEL, system_instruction=system_prompt), None
+
+
+async def analyze_code(parsed_diff: List[Dict[str, Any]], pr_details: PRDetails) -> List[Dict[str, Any]]:
+    """Analyzes the code changes using Gemini and generates review comments.
+
+    All hunks are sent to Gemini concurrently; at most GEMINI_CONCURRENCY
+    requests are in flight at any time. Results are matched back to their
+    hunks by content digest, so duplicate hunks reuse one response.
+    """
+    log.info("Number of files to analyze: %d", len(parsed_diff))
+    jobs = build_review_jobs(parsed_diff)
+    if not jobs:
+        return []
+
+    system_prompt = create_system_prompt(pr_details)
+    gemini_model, cached_content = create_review_model(system_prompt)
+
+    unique_jobs = {}
+    for job in jobs:
+        unique_jobs.setdefault(job["digest"], job)
+
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+    def request(job: Dict[str, Any]):
+        return get_ai_response(semaphore, gemini_model, system_prompt, job["prompt"], job["max_output_tokens"])
+
+    log.info("Sending %d prompts to Gemini for %d hunks...", len(unique_jobs), len(jobs))
+    try:
+        results = await asyncio.gather(
+            *[request(job) for job in unique_jobs.values()],
+            return_exceptions=True,
+        )
+    finally:
+        if cached_content is not None:
+            try:
+                cached_content.delete()
+            except Exception as e:
+                log.warning("Failed to delete Gemini cached content: %s", e)
+
+    responses = dict(zip(unique_jobs, results))
+    comments = []
+    for job in jobs:
+        file_path, hunk_index = job["key"]
+        ai_response = responses[job["digest"]]
+        if isinstance(ai_response, BaseException):
+            log.error("Error during Gemini API call for %s hunk #%d: %s", file_path, hunk_index, ai_response)
+            continue
+        log.debug("AI response received: %s", ai_response)
             
-            if ai_response:
-                new_comments = create_comment(file_info, hunk, ai_response)
-                print(f"Comments created from AI response: {new_comments}")
-                if new_comments:
-                    comments.extend(new_comments)
-                    print(f"Updated comments list: {comments}")
-
-    print(f"\nFinal comments list: {comments}")
+        if ai_response:
+            new_comments = create_comment(job["file"], job["hunk"], ai_response)
+            log.debug("Comments created from AI response: %s", new_comments)
+            if new_comments:
+                comments.extend(new_comments)
+
+    log.info("Generated %d review comments", len(comments))
     return comments
 
 
-def create_prompt(file: PatchedFile, hunk: Hunk, pr_details: PRDetails) -> str:
-    """Creates the prompt for the Gemini model."""
+def create_system_prompt(pr_details: PRDetails) -> str:
+    """Creates the system instruction shared by all hunks of the pull request."""
     return f"""You are an experienced software engineer.
 
 You are tasked to review a pull request from one of your peers.
@@ -141,13 +402,12 @@ Provide a code review with suggestions for the most impactful
 improvements based on the pull request in the following Git diff.
 Instructions:
     - Provide the response in following JSON format:  {{"reviews": [{{"lineNumber":  <line_number>, "reviewComment": "<review comment>"}}]}}
+    - Each diff line is prefixed with its line number and a tab; use that number as "lineNumber". "..." marks omitted unchanged lines.
     - Provide comments and suggestions ONLY if there is something to improve, otherwise "reviews" should be an empty array.
     - Use GitHub Markdown in comments
     - IMPORTANT: NEVER suggest adding comments to the code
     - IMPORTANT: Ignore code comment "// Package imports:" , "// Project imports:", "// Flutter imports:"
-    
-
-Review the following code diff in the file "{file.path}" and take the pull request title and description into account when writing the response.
+    - Take the pull request title and description into account when writing the response.
   
 Pull request title: {pr_details.title}
 Pull request description:
@@ -155,89 +415,158 @@ Pull request description:
 ---
 {pr_details.description or 'No description provided'}
 ---
+"""
+
+
+def format_hunk_for_prompt(hunk_lines: List[str], file_path: str = "") -> str:
+    """Renders the hunk as numbered lines, keeping only changes and nearby context.
+
+    Line numbers are positions within the hunk, so review positions still map
+    back correctly after unchanged lines are dropped. Past MAX_PROMPT_DIFF_CHARS
+    the rest of the hunk is replaced by a truncation marker.
+    """
+    keep = [False] * len(hunk_lines)
+    for index, line in enumerate(hunk_lines):
+        if is_changed_line(line):
+            start = max(0, index - PROMPT_CONTEXT_LINES)
+            end = min(len(hunk_lines), index + PROMPT_CONTEXT_LINES + 1)
+            keep[start:end] = [True] * (end - start)
+
+    rendered = []
+    skipped = False
+    for index, line in enumerate(hunk_lines):
+        if keep[index]:
+            rendered.append(f"{index + 1}\t{line}")
+            skipped = False
+        elif not skipped:
+            rendered.append("...")
+            skipped = True
+
+    body = "\n".join(rendered)
+    if len(body) > MAX_PROMPT_DIFF_CHARS:
+        # Cut at a line boundary when possible so the model never sees a partial line
+        limit = MAX_PROMPT_DIFF_CHARS - len(PROMPT_TRUNCATION_MARKER) - 1
+        cut = body.rfind("\n", 0, limit)
+        body = body[:cut if cut > 0 else limit]
+        omitted = len(rendered) - body.count("\n") - 1
+        log.info("Diff for %s truncated; %d prompt lines were not reviewed", file_path or "hunk", omitted)
+        body += "\n" + PROMPT_TRUNCATION_MARKER
+    return body
+
+
+def create_prompt(file: FileInfo, hunk: HunkInfo) -> str:
+    """Creates the per-hunk prompt for the Gemini model."""
+    diff_text = format_hunk_for_prompt(hunk.content.split("\n"), file.path)
+    return f"""Review the following code diff in the file "{file.path}".
 
 Git diff to review:
 
 ```diff
-{hunk.content}
+{diff_text}
 ```
 """
 
-def get_ai_response(prompt: str) -> List[Dict[str, str]]:
-    """Sends the prompt to Gemini API and retrieves the response."""
-    # Use 'gemini-1.5-flash-002' as a fallback default value if the environment variable isn't set
-    gemini_model = Client.GenerativeModel(os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash-002'))
-    print("===== The promt sent to Gemini is: =====")
-    print(prompt)
+async def get_ai_response(
+    semaphore: asyncio.Semaphore,
+    gemini_model: Client.GenerativeModel,
+    system_prompt: str,
+    prompt: str,
+    max_output_tokens: int = MAX_OUTPUT_TOKENS,
+) -> List[Dict[str, str]]:
+    """Sends the prompt to Gemini API and retrieves the response.
+
+    Parsed reviews are cached by model settings and prompt, so re-running on
+    unchanged hunks does not call Gemini again.
+    """
+    cache_key = cache.make_key(
+        GEMINI_MODEL,
+        GENERATION_CONFIG["temperature"],
+        max_output_tokens,
+        system_prompt,
+        prompt,
+    )
+    cached_reviews = extract_reviews({"reviews": cache.get(cache_key)})
+    if cached_reviews is not None:
+        log.debug("Using cached Gemini response: %s", cached_reviews)
+        return cached_reviews
+
+    log.debug("Prompt sent to Gemini:\n%s", prompt)
     try:
-        response = gemini_model.generate_content(prompt)
-
-        response_text = response.text.strip()
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]  # Remove ```json
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]  # Remove ```
-        response_text = response_text.strip()
-        
-        print(f"Cleaned response text: {response_text}")
-        
-        try:
-            data = json.loads(response_text)
-            print(f"Parsed JSON data: {data}")
-            
-            if "reviews" in data and isinstance(data["reviews"], list):
-                reviews = data["reviews"]
-                valid_reviews = []
-                for review in reviews:
-                    if "lineNumber" in review and "reviewComment" in review:
-                        valid_reviews.append(review)
-                    else:
-                        print(f"Invalid review format: {review}")
-                return valid_reviews
-            else:
-                print("Error: Response doesn't contain valid 'reviews' array")
-                print(f"Response content: {data}")
-                return []
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON response: {e}")
-            print(f"Raw response: {response_text}")
-            return []
+        async with semaphore:
+            response = await gemini_model.generate_content_async(
+                prompt,
+                generation_config={**GENERATION_CONFIG, "max_output_tokens": max_output_tokens},
+            )
     except Exception as e:
-        print(f"Error during Gemini API call: {e}")
+        log.error("Error during Gemini API call: %s", e)
         return []
 
-class FileInfo:
-    """Simple class to hold file information."""
-    def __init__(self, path: str):
-        self.path = path
-
-def create_comment(file: FileInfo, hunk: Hunk, ai_responses: List[Dict[str, str]]) -> List[Dict[str, Any]]:
-    """Creates comment objects from AI responses."""
-    print("AI responses in create_comment:", ai_responses)
-    print(f"Hunk details - start: {hunk.source_start}, length: {hunk.source_length}")
-    print(f"Hunk content:\n{hunk.content}")
-    
-    comments = []
-    for ai_response in ai_responses:
-        try:
-            line_number = int(ai_response["lineNumber"])
-            print(f"Original AI suggested line: {line_number}")
-            
-            # Ensure the line number is within the hunk's range
-            if line_number < 1 or line_number > hunk.source_length:
-                print(f"Warning: Line number {line_number} is outside hunk range")
-                continue
-                
-            comment = {
-                "body": ai_response["reviewComment"],
-                "path": file.path,
-                "position": line_number
-            }
-            print(f"Created comment: {json.dumps(comment, indent=2)}")
-            comments.append(comment)
-            
-        except (KeyError, TypeError, ValueError) as e:
-            print(f"Error creating comment from AI response: {e}, Response: {ai_response}")
+    try:
+        response_text = response.text
+    except ValueError as e:
+        # No text parts, e.g. a safety block or MAX_TOKENS with empty content
+        log.error("Gemini returned no text: %s", e)
+        return []
+
+    try:
+        data = json_loads(response_text)
+    except ValueError as e:
+        # Structured output is only cut short when the token budget runs out
+        log.error("Error decoding JSON response: %s", e)
+        log.debug("Raw response: %s", response_text)
+        return []
+    log.debug("Parsed JSON data: %s", data)
+
+    reviews = extract_reviews(data)
+    if reviews is None:
+        log.error("Response doesn't contain a valid 'reviews' array")
+        log.debug("Response content: %s", data)
+        return []
+    cache.put(cache_key, reviews)
+    return reviews
+
+
+def extract_reviews(data: Any) -> Optional[List[Dict[str, Any]]]:
+    """Returns the dict items of data["reviews"], or None if there is no reviews array."""
+    reviews = data.get("reviews") if isinstance(data, dict) else None
+    if not isinstance(reviews, list):
+        return None
+    return [review for review in reviews if isinstance(review, dict)]
+
+
+def review_position(review: Dict[str, Any]) -> int:
+    """Returns the review's line number, or 0 if it is missing or not an integer."""
+    line_number = review.get("lineNumber")
+    # bool is an int subclass, but True/False are not line numbers
+    if isinstance(line_number, int) and not isinstance(line_number, bool):
+        return line_number
+    if isinstance(line_number, str) and line_number.strip().isdecimal():
+        return int(line_number)
+    return 0
+
+
+def create_comment(file: FileInfo, hunk: HunkInfo, ai_responses: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """Creates comment objects from AI responses.
+
+    Responses without a non-empty comment or with an invalid line number are
+    dropped and reported together.
+    """
+    log.debug("AI responses in create_comment: %s", ai_responses)
+    log.debug("Hunk details - start: %d, length: %d", hunk.source_start, hunk.source_length)
+
+    path = file.path
+    hunk_length = hunk.source_length
+    comments = [
+        {"body": review["reviewComment"], "path": path, "position": position}
+        for review in ai_responses
+        if isinstance(review.get("reviewComment"), str)
+        and review["reviewComment"].strip()
+        and 1 <= (position := review_position(review)) <= hunk_length
+    ]
+
+    dropped = len(ai_responses) - len(comments)
+    if dropped:
+        log.warning("Dropped %d AI responses with a missing or empty comment or an invalid line number", dropped)
     return comments
 
 def create_review_comment(
@@ -245,105 +574,126 @@ def create_review_comment(
     repo: str,
     pull_number: int,
     comments: List[Dict[str, Any]],
+    body: str = REVIEW_BODY,
 ):
     """Submits the review comments to the GitHub API."""
-    print(f"Attempting to create {len(comments)} review comments")
-    print(f"Comments content: {json.dumps(comments, indent=2)}")
+    log.info("Attempting to create %d review comments", len(comments))
+    log.debug("Comments content: %s", comments)
 
-    repo = gh.get_repo(f"{owner}/{repo}")
-    pr = repo.get_pull(pull_number)
+    pr = get_pull(f"{owner}/{repo}", pull_number)
     try:
         # Create the review with only the required fields
         review = pr.create_review(
-            body="Gemini AI Code Reviewer Comments",
+            body=body,
             comments=comments,
             event="COMMENT"
         )
-        print(f"Review created successfully with ID: {review.id}")
+        log.info("Review created successfully with ID: %s", review.id)
         
     except Exception as e:
-        print(f"Error creating review: {str(e)}")
-        print(f"Error type: {type(e)}")
-        print(f"Review payload: {comments}")
+        log.error("Error creating review (%s): %s", type(e).__name__, e)
+        log.debug("Review payload: %s", comments)
+
+def parse_diff(diff_lines: Iterable[str]) -> List[Dict[str, Any]]:
+    """Parses the diff lines and returns a structured format.
 
-def parse_diff(diff_str: str) -> List[Dict[str, Any]]:
-    """Parses the diff string and returns a structured format."""
+    Accepts any iterable of lines, so a streamed diff can be parsed as it
+    arrives. Wrap a diff string with str.splitlines() to parse it directly.
+    """
     files = []
     current_file = None
     current_hunk = None
-    
-    for line in diff_str.splitlines():
+
+    for line in diff_lines:
         if line.startswith('diff --git'):
-            if current_file:
-                files.append(current_file)
             current_file = {'path': '', 'hunks': []}
-            
-        elif line.startswith('--- a/'):
-            if current_file:
-                current_file['path'] = line[6:]
-                
-        elif line.startswith('+++ b/'):
-            if current_file:
-                current_file['path'] = line[6:]
-                
+            files.append(current_file)
+            current_hunk = None
+
+        elif current_file is None:
+            continue
+
         elif line.startswith('@@'):
-            if current_file:
-                current_hunk = {'header': line, 'lines': []}
-                current_file['hunks'].append(current_hunk)
-                
+            current_hunk = {'header': line, 'lines': []}
+            current_file['hunks'].append(current_hunk)
+
         elif current_hunk is not None:
+            # Inside a hunk, '--- a/' and '+++ b/' are removed/added lines
             current_hunk['lines'].append(line)
-            
-    if current_file:
-        files.append(current_file)
-        
+
+        elif line.startswith('--- a/') or line.startswith('+++ b/'):
+            current_file['path'] = line[6:]
+
     return files
 
 
+def compile_exclude_patterns(exclude: str) -> Optional[Pattern[str]]:
+    """Compiles the comma-separated exclude globs into one regex, or None if empty."""
+    exclude_patterns = [s.strip() for s in exclude.split(",") if s.strip()]
+    if not exclude_patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in exclude_patterns))
+
+
+def run(pr_details: PRDetails):
+    """Reviews the pull request diff and posts the resulting comments."""
+    parsed_diff = parse_diff(get_diff(pr_details.owner, pr_details.repo, pr_details.pull_number))
+    if not parsed_diff:
+        log.info("There is no diff found")
+        return
+
+    exclude_re = compile_exclude_patterns(os.environ.get("INPUT_EXCLUDE", ""))
+    filtered_diff = [
+        file
+        for file in parsed_diff
+        if not (exclude_re and exclude_re.match(file.get('path', '')))
+    ]
+
+    limited_diff, skipped_files = limit_hunks(filtered_diff)
+
+    cache.sweep()
+
+    comments = asyncio.run(analyze_code(limited_diff, pr_details))
+    if comments or skipped_files:
+        body = REVIEW_BODY
+        if skipped_files:
+            body += (
+                "\n\nThis pull request exceeds the review limits, so some hunks were not reviewed in:\n"
+                + "\n".join(f"- `{path}`" for path in skipped_files)
+            )
+        try:
+            create_review_comment(
+                pr_details.owner, pr_details.repo, pr_details.pull_number, comments, body
+            )
+        except Exception as e:
+            log.error("Error in create_review_comment: %s", e)
+
 
 def main():
     """Main function to execute the code review process."""
-    pr_details = get_pr_details()
-    event_data = json.load(open(os.environ["GITHUB_EVENT_PATH"], "r"))
+    pr_details, event_data = load_event()
 
     event_name = os.environ.get("GITHUB_EVENT_NAME")
     if event_name == "issue_comment":
         # Process comment trigger
         if not event_data.get("issue", {}).get("pull_request"):
-            print("Comment was not on a pull request")
+            log.info("Comment was not on a pull request")
             return
-
-        diff = get_diff(pr_details.owner, pr_details.repo, pr_details.pull_number)
-        if not diff:
-            print("There is no diff found")
-            return
-
-        parsed_diff = parse_diff(diff)
-
-        exclude_patterns = os.environ.get("INPUT_EXCLUDE", "").split(",")
-        exclude_patterns = [s.strip() for s in exclude_patterns]
-
-        filtered_diff = [
-            file
-            for file in parsed_diff
-            if not any(fnmatch.fnmatch(file.get('path', ''), pattern) for pattern in exclude_patterns)
-        ]
-
-        comments = analyze_code(filtered_diff, pr_details)
-        if comments:
-            try:
-                create_review_comment(
-                    pr_details.owner, pr_details.repo, pr_details.pull_number, comments
-                )
-            except Exception as e:
-                print("Error in create_review_comment:", e)
+        run(pr_details)
+    elif event_name == "pull_request" and event_data.get("action") in ("opened", "synchronize"):
+        run(pr_details)
     else:
-        print("Unsupported event:", os.environ.get("GITHUB_EVENT_NAME"))
+        log.info("Unsupported event: %s", event_name)
         return
 
 
 if __name__ == "__main__":
+    log_level = os.environ.get("LOG_LEVEL", "INFO").strip().upper()
+    # Unknown names (e.g. a typo) fall back to INFO instead of aborting the run
+    if not isinstance(logging.getLevelName(log_level), int):
+        log_level = "INFO"
+    logging.basicConfig(level=log_level, format="%(levelname)s %(message)s")
     try:
         main()
     except Exception as error:
-        print("Error:", error)
+        log.error("Error: %s", error)